@@ -18,7 +18,11 @@
 
 import unittest
 from unittest.mock import patch
+import contextlib
 import datetime
+import io
+import os
+import tempfile
 import time_capture
 
 
@@ -35,7 +39,7 @@ class TestTimeCaptureGetStash(unittest.TestCase):
 
         mockinit.assert_called()
 
-    @patch('time_capture.json.load')
+    @patch('time_capture._loads')
     @patch('time_capture.open')
     def test_stash_json_decode_error(self, _, mockload):
         '''file contents cannot be decoded'''
@@ -45,6 +49,83 @@ class TestTimeCaptureGetStash(unittest.TestCase):
             time_capture._get_stash('./test/', None)
 
 
+class TestTimeCaptureUpdate(unittest.TestCase):
+    '''unit tests for update'''
+
+    def test_unchanged_stash_is_not_written(self):
+        '''the stash file is only written if its contents changed'''
+        with tempfile.TemporaryDirectory() as path, \
+                contextlib.redirect_stdout(io.StringIO()):
+            time_capture.update(
+                path, datetime.datetime(2000, 1, 1, 8, 0, 10))
+            with patch('time_capture.open', wraps=open) as mockopen:
+                time_capture.update(
+                    path, datetime.datetime(2000, 1, 1, 8, 0, 50))
+
+        modes = [call.args[1] for call in mockopen.call_args_list]
+        self.assertNotIn('wb', modes)
+
+    def test_printed_presence_matches_log(self):
+        '''the presence on screen and in the log are the same'''
+        stash = time_capture._init_stash(datetime.datetime(2000, 1, 1, 8))
+        stash['breaks'] = [{'start': datetime.time(9),
+                            'end': datetime.time(10)},
+                           {'start': datetime.time(9, 30),
+                            'end': datetime.time(10, 30)}]
+        output = io.StringIO()
+        with tempfile.TemporaryDirectory() as path, \
+                contextlib.redirect_stdout(output):
+            stash_file_path = os.path.join(path, 'timeStash.json')
+            with open(stash_file_path, 'wb') as stash_file:
+                stash_file.write(time_capture._dumps(stash))
+
+            time_capture.update(path, datetime.datetime(2000, 1, 1, 12))
+            printed = output.getvalue().splitlines()[0]
+            time_capture.update(path, datetime.datetime(2000, 1, 2, 8))
+
+            with open(os.path.join(path, '2000_01.csv')) as log_file:
+                logged = log_file.read()
+
+        self.assertEqual(printed, 'Anwesenheit:  2:00 h')
+        self.assertEqual(logged, '01.01.2000;08:00;12:00;2:00\n')
+
+
+class TestTimeCaptureDumpsLoads(unittest.TestCase):
+    '''unit tests for _dumps and _loads'''
+
+    def test_round_trip(self):
+        '''a serialized stash is restored unchanged'''
+        test_time = datetime.datetime(2000, 1, 1, 12, 15)
+        stash = time_capture._init_stash(test_time)
+
+        result = time_capture._loads(time_capture._dumps(stash))
+
+        self.assertEqual(result, stash)
+
+    def test_user_keys_are_kept(self):
+        '''keys added by the user are serialized, whatever their name'''
+        test_time = datetime.datetime(2000, 1, 1, 12, 15)
+        stash = time_capture._init_stash(test_time)
+        stash['_comment'] = 'edited by hand'
+
+        result = time_capture._loads(time_capture._dumps(stash))
+
+        self.assertEqual(result['_comment'], 'edited by hand')
+
+    def test_many_breaks(self):
+        '''large stashes serialize to the same bytes with and without orjson'''
+        test_time = datetime.datetime(2000, 1, 1, 12, 15)
+        stash = time_capture._init_stash(test_time)
+        stash['breaks'] = stash['breaks'] * time_capture.ORJSON_MIN_BREAKS
+
+        data = time_capture._dumps(stash)
+        with patch('time_capture._get_orjson', return_value=None):
+            stdlib_data = time_capture._dumps(stash)
+
+        self.assertEqual(data, stdlib_data)
+        self.assertEqual(time_capture._loads(data), stash)
+
+
 class TestTimeCaptureInit(unittest.TestCase):
 
     '''unit tests for init'''
@@ -116,6 +197,17 @@ class TestTimeCaptureStringToDatetime(unittest.TestCase):
 
         self.assertEqual(result, expected_dict)
 
+    def test_malformed_strings_are_kept(self):
+        '''strings resembling the time formats are not converted'''
+        test_list = [('one', '2000-01-01Tab:cd'),
+                     ('two', 'ab:cd')]
+        expected_dict = {'one': '2000-01-01Tab:cd',
+                         'two': 'ab:cd'}
+
+        result = time_capture._string_to_datetime(test_list)
+
+        self.assertEqual(result, expected_dict)
+
 
 class TestWriteLog(unittest.TestCase):
     '''unit tests for _write_log'''
@@ -133,13 +225,18 @@ class TestWriteLog(unittest.TestCase):
                                 {'start': datetime.time(12, 30),
                                  'end': datetime.time(13)}]
 
-        mockopen = unittest.mock.mock_open()
-        with patch('time_capture.open', mockopen):
+        with patch('time_capture.os.open') as mockopen, \
+                patch('time_capture.os.write') as mockwrite, \
+                patch('time_capture.os.close') as mockclose:
             time_capture._write_log('/path/to/file', test_stash)
 
-        mockopen.assert_called_with('/path/to/file/2000_02.csv', 'a')
-        mockwrite = mockopen()
-        mockwrite.write.assert_called_with('04.02.2000;07:30;17:45;9:30\n')
+        mockopen.assert_called_with(
+            '/path/to/file/2000_02.csv',
+            time_capture.os.O_WRONLY | time_capture.os.O_APPEND
+            | time_capture.os.O_CREAT, 0o666)
+        mockwrite.assert_called_with(mockopen.return_value,
+                                     b'04.02.2000;07:30;17:45;9:30\n')
+        mockclose.assert_called_with(mockopen.return_value)
 
 
 class TestTimeCaptureCalcTimeOverlap(unittest.TestCase):
@@ -206,6 +303,16 @@ class TestTimeCaptureCalcTimeOverlap(unittest.TestCase):
 
         self.assertEqual(break_time, datetime.timedelta(minutes=5))
 
+    def test_second_is_tuple(self):
+        '''second is a tuple of datetimes'''
+        first = {'start': datetime.datetime(2000, 1, 1, 9, 5),
+                 'end': datetime.datetime(2000, 1, 1, 9, 10)}
+        second = (datetime.datetime(2000, 1, 1, 9),
+                  datetime.datetime(2000, 1, 1, 9, 15))
+        break_time = time_capture.calc_time_overlap(first, second)
+
+        self.assertEqual(break_time, datetime.timedelta(minutes=5))
+
 
 class TestTimeCaptureGetBreaksDuration(unittest.TestCase):
     '''unittests for get_breaks_duration'''
@@ -246,6 +353,34 @@ class TestTimeCaptureGetBreaksDuration(unittest.TestCase):
 
         self.assertEqual(breaks_time, datetime.timedelta(minutes=0))
 
+    @unittest.skipIf(time_capture._get_numpy() is None,
+                     'numpy is not installed')
+    def test_many_breaks(self):
+        '''the vectorized path matches the sum of the single overlaps'''
+        breaks = [{'start': datetime.time(hour),
+                   'end': datetime.time(hour, 20)} for hour in range(6, 18)]
+        work = {'start': datetime.datetime(2000, 1, 1, 7, 10),
+                'end': datetime.datetime(2000, 1, 1, 16, 5)}
+
+        breaks_time = time_capture.get_breaks_duration(work, breaks)
+
+        self.assertEqual(breaks_time, datetime.timedelta(minutes=175))
+
+    @unittest.skipIf(time_capture._get_numpy() is None,
+                     'numpy is not installed')
+    @patch('time_capture.USE_NUMBA', True)
+    def test_many_breaks_kernel(self):
+        '''the compiled kernel matches the sum of the single overlaps'''
+        breaks = [{'start': datetime.time(hour, minute),
+                   'end': datetime.time(hour, minute + 10)}
+                  for hour in range(6, 18) for minute in (0, 30)]
+        work = {'start': datetime.datetime(2000, 1, 1, 7, 5),
+                'end': datetime.datetime(2000, 1, 1, 16, 5)}
+
+        breaks_time = time_capture.get_breaks_duration(work, breaks)
+
+        self.assertEqual(breaks_time, datetime.timedelta(minutes=180))
+
 
 class TestTimeCaptureGetPresence(unittest.TestCase):
     '''untitests for get_presence'''
@@ -264,6 +399,110 @@ class TestTimeCaptureGetPresence(unittest.TestCase):
         self.assertEqual(presence, datetime.timedelta(hours=9, minutes=15))
 
 
+class TestTimeCaptureCalcPresenceAndTargetTimes(unittest.TestCase):
+    '''unittests for _calc_presence_and_target_times'''
+
+    def setUp(self):
+        self.breaks = [{'start': datetime.time(12, 30),
+                        'end': datetime.time(13)},
+                       {'start': datetime.time(9),
+                        'end': datetime.time(9, 15)}]
+        self.starts, self.ends = time_capture._get_breaks_arrays(
+            datetime.date(2000, 1, 1), self.breaks)
+
+    def test_presence(self):
+        '''the presence is the worktime without the breaks'''
+        presence, _ = time_capture._calc_presence_and_target_times(
+            datetime.datetime(2000, 1, 1, 7),
+            datetime.datetime(2000, 1, 1, 17),
+            self.starts, self.ends, [])
+
+        self.assertEqual(presence, datetime.timedelta(hours=9, minutes=15))
+
+    def test_end_during_break(self):
+        '''the part of the break after the end is not subtracted'''
+        presence, _ = time_capture._calc_presence_and_target_times(
+            datetime.datetime(2000, 1, 1, 7),
+            datetime.datetime(2000, 1, 1, 12, 45),
+            self.starts, self.ends, [])
+
+        self.assertEqual(presence, datetime.timedelta(hours=5, minutes=15))
+
+    def test_targets_out_of_order(self):
+        '''the target times are returned in the order of the targets'''
+        targets = [datetime.timedelta(hours=10),
+                   datetime.timedelta(hours=1),
+                   datetime.timedelta(hours=5)]
+
+        _, target_times = time_capture._calc_presence_and_target_times(
+            datetime.datetime(2000, 1, 1, 7),
+            datetime.datetime(2000, 1, 1, 7),
+            self.starts, self.ends, targets)
+
+        self.assertEqual(target_times,
+                         [datetime.datetime(2000, 1, 1, 17, 45),
+                          datetime.datetime(2000, 1, 1, 8),
+                          datetime.datetime(2000, 1, 1, 12, 15)])
+
+    def test_presence_matches_get_presence(self):
+        '''overlapping breaks are subtracted like in get_presence'''
+        breaks = [{'start': datetime.time(9),
+                   'end': datetime.time(10)},
+                  {'start': datetime.time(9, 30),
+                   'end': datetime.time(10, 30)}]
+        work = {'start': datetime.datetime(2000, 1, 1, 8),
+                'end': datetime.datetime(2000, 1, 1, 12)}
+        starts, ends = time_capture._get_breaks_arrays(
+            datetime.date(2000, 1, 1), breaks)
+
+        presence, _ = time_capture._calc_presence_and_target_times(
+            work['start'], work['end'], starts, ends, [])
+
+        self.assertEqual(presence, time_capture.get_presence(work, breaks))
+        self.assertEqual(presence, datetime.timedelta(hours=2))
+
+    def test_many_breaks(self):
+        '''the presence of many breaks matches get_presence'''
+        breaks = [{'start': datetime.time(hour),
+                   'end': datetime.time(hour, 20)} for hour in range(6, 18)]
+        work = {'start': datetime.datetime(2000, 1, 1, 7, 10),
+                'end': datetime.datetime(2000, 1, 1, 16, 5)}
+        starts, ends = time_capture._get_breaks_arrays(
+            datetime.date(2000, 1, 1), breaks)
+
+        presence, _ = time_capture._calc_presence_and_target_times(
+            work['start'], work['end'], starts, ends, [])
+
+        self.assertEqual(presence, time_capture.get_presence(work, breaks))
+
+    def test_without_end(self):
+        '''no presence is calculated without an end'''
+        presence, _ = time_capture._calc_presence_and_target_times(
+            datetime.datetime(2000, 1, 1, 7), None,
+            self.starts, self.ends, [])
+
+        self.assertIsNone(presence)
+
+class TestTimeCaptureGetHourMinuteStr(unittest.TestCase):
+    '''unittests for get_hour_minute_str'''
+
+    def test_seconds_are_ignored(self):
+        '''hours are not padded and seconds are cut off'''
+        presence = datetime.timedelta(hours=9, minutes=5, seconds=59)
+
+        presence_str = time_capture.get_hour_minute_str(presence)
+
+        self.assertEqual(presence_str, '9:05')
+
+    def test_negative_duration(self):
+        '''negative durations get a sign'''
+        presence = datetime.timedelta(hours=-1, minutes=-30)
+
+        presence_str = time_capture.get_hour_minute_str(presence)
+
+        self.assertEqual(presence_str, '-1:30')
+
+
 class TestTimeCaptureGetTargetTime(unittest.TestCase):
     '''unittests for get_target_time'''
 
@@ -283,6 +522,52 @@ class TestTimeCaptureGetTargetTime(unittest.TestCase):
 
         self.assertEqual(target_time, datetime.datetime(2000, 1, 1, 10, 20))
 
+    def test_work_starts_during_break(self):
+        '''the part of the break after the work start is skipped'''
+
+        breaks = [{'start': datetime.time(12, 30),
+                   'end': datetime.time(13)},
+                  {'start': datetime.time(9),
+                   'end': datetime.time(9, 15)}]
+        work = {'start': datetime.datetime(2000, 1, 1, 9, 5)}
+        stash = {'breaks': breaks, 'work': work}
+
+        target = datetime.timedelta(minutes=240)
+
+        target_time = time_capture.get_target_time(stash, target)
+
+        self.assertEqual(target_time, datetime.datetime(2000, 1, 1, 13, 45))
+
+    def test_overlapping_breaks(self):
+        '''the presence at the target time is the target'''
+        breaks = [{'start': datetime.time(9),
+                   'end': datetime.time(10)},
+                  {'start': datetime.time(9, 30),
+                   'end': datetime.time(10, 30)}]
+        work = {'start': datetime.datetime(2000, 1, 1, 8)}
+        stash = {'breaks': breaks, 'work': work}
+
+        target = datetime.timedelta(minutes=180)
+
+        target_time = time_capture.get_target_time(stash, target)
+
+        self.assertEqual(target_time, datetime.datetime(2000, 1, 1, 13))
+        presence = time_capture.get_presence(
+            {'start': work['start'], 'end': target_time}, breaks)
+        self.assertEqual(presence, target)
+
+    def test_breaks_changed(self):
+        '''the current breaks of the stash are used'''
+        stash = time_capture._init_stash(datetime.datetime(2000, 1, 1, 7, 30))
+        time_capture.get_target_time(stash, datetime.timedelta(hours=8))
+        stash['breaks'] = []
+
+        target = datetime.timedelta(hours=8, minutes=30)
+
+        target_time = time_capture.get_target_time(stash, target)
+
+        self.assertEqual(target_time, datetime.datetime(2000, 1, 1, 16))
+
 
 if __name__ == '__main__':
     unittest.main()